@@ -0,0 +1,174 @@
+import asyncio
+import datetime
+import unicodedata
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from astrbot.api import logger
+
+from .quota import GLOBAL_SCOPES, QuotaLedger
+from .service import ImageService
+
+# 格式: "生成描述|关键词 关键词"，"/" 分隔同义词；省略关键词时要求提示词包含完整描述
+DEFAULT_POSES = [
+    "对着镜子的半身自拍|镜子/镜前 自拍",
+    "坐在窗边看向镜头的自拍|窗边/窗前/窗户 自拍",
+    "在咖啡店喝咖啡的自拍|咖啡",
+    "在街头散步的全身照|街头/街道/街上/马路 散步/漫步/逛街",
+]
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def parse_pose(entry: str) -> tuple[str, list[list[str]]]:
+    """解析姿势配置，返回 (生成描述, 关键词组)"""
+    desc, _, keywords = entry.partition("|")
+    desc = desc.strip()
+    groups = [
+        [w for w in group.split("/") if w]
+        for group in _normalize(keywords).split()
+    ]
+    return desc, [g for g in groups if g] or [[_normalize(desc)]]
+
+
+def match_score(prompt: str, groups: list[list[str]]) -> float:
+    """提示词命中的关键词组比例 (每组任一同义词出现即可)"""
+    text = _normalize(prompt)
+    return sum(1 for g in groups if any(w in text for w in g)) / len(groups)
+
+
+class SelfiePrefetcher:
+    """空闲时预生成今日穿搭的自拍，命中时直接发送"""
+
+    def __init__(
+        self,
+        config: dict,
+        service: ImageService,
+        quota: QuotaLedger,
+        get_outfit: Callable[[], Awaitable[str]],
+        build_prompt: Callable[[str, str], Awaitable[str]],
+        is_idle: Callable[[], bool],
+    ):
+        self.config = config
+        self.service = service
+        self.quota = quota
+        self._get_outfit = get_outfit
+        self._build_prompt = build_prompt
+        self._is_idle = is_idle
+
+        # 预生成池: pose -> 图片路径，仅对 _state 对应的 (日期, 穿搭, 尺寸) 有效
+        self._pool: dict[str, Path] = {}
+        self._state: tuple[str, str, str] | None = None
+        self._task: asyncio.Task | None = None
+        self.served = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.config.get("selfie_prefetch_enabled", False))
+
+    @property
+    def poses(self) -> list[str]:
+        poses = self.config.get("selfie_prefetch_poses") or DEFAULT_POSES
+        return [str(p).strip() for p in poses if str(p).strip()]
+
+    def _current_state(self, outfit: str) -> tuple[str, str, str]:
+        today = datetime.datetime.now().strftime("%Y-%m-%d")
+        return today, outfit, self.config.get("size", "1024x1024")
+
+    def _sync_state(self, outfit: str):
+        """穿搭变化或跨天时作废整个池"""
+        state = self._current_state(outfit)
+        if state != self._state:
+            if self._pool:
+                logger.info(f"[SelfiePrefetch] 穿搭或日期变化，作废 {len(self._pool)} 张预生成图片")
+            self._pool.clear()
+            self._state = state
+
+    async def start(self):
+        if self.enabled and not self._task:
+            self._task = asyncio.create_task(self._prefetch_loop())
+            logger.info("[GiteeAIImage] 自拍预生成任务已启动")
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self._pool.clear()
+
+    async def _prefetch_loop(self):
+        await asyncio.sleep(10)
+        while True:
+            try:
+                await self._prefetch_once()
+            except Exception as e:
+                logger.warning(f"[SelfiePrefetch] 预生成失败: {e}")
+            await asyncio.sleep(self.config.get("selfie_prefetch_interval", 60))
+
+    async def _prefetch_once(self):
+        outfit = await self._get_outfit()
+        self._sync_state(outfit)
+        if not self._is_idle():
+            return
+
+        # 文件可能已被缓存清理删除
+        for pose in [p for p, path in self._pool.items() if not path.is_file()]:
+            del self._pool[pose]
+
+        missing = [p for p in self.poses if p not in self._pool]
+        if not missing:
+            return
+
+        # 计入全局额度，不足时跳过本轮
+        size = self._state[2]
+        steps = self.config.get("num_inference_steps", 9)
+        charged = self.quota.try_charge(GLOBAL_SCOPES, size, steps)
+        if charged is None:
+            logger.debug("[SelfiePrefetch] 全局额度不足，跳过本轮预生成")
+            return
+
+        # 每轮只生成一张，尽量不占用 Key 池
+        pose = missing[0]
+        try:
+            final_prompt = await self._build_prompt(parse_pose(pose)[0], outfit)
+            image_path = await self.service.generate(final_prompt, size=size, steps=steps)
+        except Exception:
+            self.quota.refund(GLOBAL_SCOPES, charged)
+            raise
+
+        # 生成期间穿搭可能已变化
+        if self._state == self._current_state(outfit):
+            self._pool[pose] = image_path
+            logger.debug(f"[SelfiePrefetch] 已预生成: {pose}")
+
+    async def take(self, prompt: str, outfit: str) -> Path | None:
+        """按姿势关键词匹配预生成的自拍，命中后从池中取出"""
+        if not self.enabled:
+            return None
+        self._sync_state(outfit)
+        if not self._pool:
+            return None
+
+        # 关键词覆盖率最高者优先，同分时关键词组更多 (更具体) 者优先
+        threshold = float(self.config.get("selfie_prefetch_threshold", 1.0))
+        best_pose, best_key = None, (0.0, 0)
+        for pose in self._pool:
+            groups = parse_pose(pose)[1]
+            key = (match_score(prompt, groups), len(groups))
+            if key > best_key:
+                best_pose, best_key = pose, key
+
+        best_score = best_key[0]
+        if best_pose is None or best_score < threshold:
+            return None
+
+        path = self._pool.pop(best_pose)
+        if not path.is_file():
+            return None
+        self.served += 1
+        logger.info(f"[SelfiePrefetch] 命中预生成自拍: {best_pose} ({best_score:.2f})")
+        return path
+
+    def get_stats(self) -> dict:
+        return {"ready": len(self._pool), "total": len(self.poses), "served": self.served}
@@ -0,0 +1,202 @@
+import hashlib
+import re
+import time
+import unicodedata
+from pathlib import Path
+
+# MinHash 参数: 64 个哈希 = 16 个 band x 4 行
+NUM_PERM = 64
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERM // LSH_BANDS
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+# 固定种子，保证重启后指纹一致
+_PERMS = [
+    (
+        int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % (_PRIME - 1) + 1,
+        int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _PRIME,
+    )
+    for i in range(NUM_PERM)
+]
+
+_SPLIT_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def prompt_tokens(text: str) -> frozenset[str]:
+    """按标点/空白切分为词 (中文为短句)，忽略大小写、全半角与语序"""
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    return frozenset(t for t in _SPLIT_RE.split(text) if t)
+
+
+def normalize_prompt(text: str) -> str:
+    """规范化后的提示词，仅在标点、空白、语序上不同的提示词得到相同文本"""
+    return " ".join(sorted(prompt_tokens(text)))
+
+
+def fingerprint(tokens: frozenset[str]) -> tuple[int, ...]:
+    """词级 MinHash 签名，仅用于 LSH 召回候选"""
+    hashes = [
+        int.from_bytes(hashlib.blake2b(t.encode(), digest_size=4).digest(), "big")
+        for t in tokens
+    ] or [0]
+    return tuple(
+        min(((a * h + b) % _PRIME) & _MAX_HASH for h in hashes)
+        for a, b in _PERMS
+    )
+
+
+def jaccard(a: frozenset[str], b: frozenset[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class PromptCache:
+    """近似提示词缓存：按 (模型, 尺寸, 范围) 分桶
+
+    默认仅在规范化后的词集合完全一致时命中；开启模糊匹配后，
+    通过词级 MinHash-LSH 召回候选，再按真实 Jaccard 相似度判定。
+    """
+
+    def __init__(self, config: dict):
+        self.config = config
+        # scope -> {entry_id: (词集合, signature, path, created_at)}
+        self._entries: dict[str, dict[int, tuple[frozenset[str], tuple[int, ...], Path, float]]] = {}
+        # scope -> {规范化文本: entry_id}
+        self._exact: dict[str, dict[str, int]] = {}
+        # scope -> {(band_idx, band_hash): {entry_id}}
+        self._buckets: dict[str, dict[tuple[int, int], set[int]]] = {}
+        self._next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.config.get("similar_cache_enabled", False))
+
+    @property
+    def fuzzy(self) -> bool:
+        return bool(self.config.get("similar_cache_fuzzy", False))
+
+    @property
+    def threshold(self) -> float:
+        return float(self.config.get("similar_cache_threshold", 0.95))
+
+    @property
+    def ttl(self) -> float:
+        return self.config.get("similar_cache_ttl_minutes", 30) * 60
+
+    @staticmethod
+    def _bands(sig: tuple[int, ...]):
+        for i in range(LSH_BANDS):
+            yield i, hash(sig[i * LSH_ROWS:(i + 1) * LSH_ROWS])
+
+    @staticmethod
+    def make_scope(model: str, size: str, tag: str = "") -> str:
+        return f"{model}|{size}|{tag}"
+
+    def lookup(self, text: str, scope: str) -> Path | None:
+        """返回规范化后一致 (或模糊模式下相似度超过阈值) 的最近一次生成结果"""
+        if not self.enabled:
+            return None
+        self._expire(scope)
+
+        tokens = prompt_tokens(text)
+        entries = self._entries.get(scope, {})
+        best_id = self._exact.get(scope, {}).get(normalize_prompt(text))
+
+        if best_id is None and self.fuzzy:
+            buckets = self._buckets.get(scope, {})
+            candidates: set[int] = set()
+            for band in self._bands(fingerprint(tokens)):
+                candidates |= buckets.get(band, set())
+
+            best_score = 0.0
+            for eid in candidates:
+                score = jaccard(tokens, entries[eid][0])
+                # 同分取较新的 (entry_id 递增)
+                if score > best_score or (score == best_score and best_id is not None and eid > best_id):
+                    best_id, best_score = eid, score
+            if best_score < self.threshold:
+                best_id = None
+
+        if best_id is not None:
+            path = entries[best_id][2]
+            if path.is_file():
+                self.hits += 1
+                return path
+            # 图片已被缓存清理删除
+            self._remove(scope, best_id)
+
+        self.misses += 1
+        return None
+
+    def store(self, text: str, scope: str, path: Path):
+        if not self.enabled:
+            return
+        self._expire_all()
+        tokens = prompt_tokens(text)
+        sig = fingerprint(tokens)
+        eid = self._next_id
+        self._next_id += 1
+        self._entries.setdefault(scope, {})[eid] = (tokens, sig, path, time.time())
+        exact = self._exact.setdefault(scope, {})
+        old = exact.get(normalize_prompt(text))
+        if old is not None:
+            self._remove(scope, old)
+        exact[normalize_prompt(text)] = eid
+        buckets = self._buckets.setdefault(scope, {})
+        for band in self._bands(sig):
+            buckets.setdefault(band, set()).add(eid)
+
+        # 每个分桶只保留最近的若干条
+        entries = self._entries[scope]
+        max_entries = self.config.get("similar_cache_max_entries", 100)
+        while len(entries) > max_entries:
+            self._remove(scope, min(entries))
+
+    def _remove(self, scope: str, eid: int):
+        tokens, sig, _, _ = self._entries[scope].pop(eid)
+        key = " ".join(sorted(tokens))
+        if self._exact[scope].get(key) == eid:
+            del self._exact[scope][key]
+        buckets = self._buckets[scope]
+        for band in self._bands(sig):
+            ids = buckets.get(band)
+            if ids:
+                ids.discard(eid)
+                if not ids:
+                    del buckets[band]
+
+    def _expire(self, scope: str):
+        entries = self._entries.get(scope)
+        if entries is None:
+            return
+        now = time.time()
+        for eid in [k for k, v in entries.items() if now - v[3] > self.ttl]:
+            self._remove(scope, eid)
+        # 旧穿搭等不再使用的分桶直接删除
+        if not entries:
+            del self._entries[scope]
+            self._exact.pop(scope, None)
+            self._buckets.pop(scope, None)
+
+    def _expire_all(self):
+        for scope in list(self._entries):
+            self._expire(scope)
+
+    def get_stats(self) -> dict:
+        self._expire_all()
+        total = self.hits + self.misses
+        return {
+            "entries": sum(len(v) for v in self._entries.values()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def clear_all(self):
+        self._entries.clear()
+        self._exact.clear()
+        self._buckets.clear()
@@ -0,0 +1,210 @@
+import json
+import time
+from pathlib import Path
+
+from astrbot.api import logger
+
+# 基准: 1024x1024、9 步的一次文生图记为 1 点
+BASE_PIXELS = 1024 * 1024
+BASE_STEPS = 9
+SCOPE_KINDS = ("user", "group", "global")
+DEFAULT_LIMITS = {
+    # kind: (容量, 每小时恢复)
+    "user": (20, 10),
+    "group": (60, 30),
+    "global": (200, 100),
+}
+# 账本落盘的最小间隔(秒)
+SAVE_INTERVAL = 30
+# 后台任务 (如自拍预生成) 只计入全局额度
+GLOBAL_SCOPES = [("global", "global")]
+
+
+class QuotaLedger:
+    """按 用户/群/全局 三级令牌桶记账，持久化到插件数据目录"""
+
+    def __init__(self, config: dict, data_dir: Path):
+        self.config = config
+        self.path = data_dir / "quota.json"
+        # key -> {"tokens": 剩余点数, "updated": 上次恢复时间, "used": 恢复满额前的消耗}
+        self._buckets: dict[str, dict] = self._load()
+        self._dirty = False
+        self._last_save = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.config.get("quota_enabled", False))
+
+    # ========== 持久化 ==========
+
+    def _load(self) -> dict:
+        if not self.path.is_file():
+            return {}
+        try:
+            return json.loads(self.path.read_text(encoding="utf-8"))
+        except Exception as e:
+            logger.warning(f"[GiteeAIImage] 额度账本读取失败，将重新计数: {e}")
+            return {}
+
+    def _is_full(self, key: str, bucket: dict, now: float) -> bool:
+        capacity, refill = self._limits(key.split(":", 1)[0])
+        if capacity <= 0:
+            return True
+        tokens = bucket["tokens"] + max(0.0, now - bucket["updated"]) * refill / 3600
+        return tokens >= capacity
+
+    def _prune(self):
+        """已恢复满额的桶与新建桶等价，直接丢弃，避免账本无限增长"""
+        now = time.time()
+        for key in [k for k, b in self._buckets.items() if self._is_full(k, b, now)]:
+            del self._buckets[key]
+
+    def _mark_dirty(self):
+        """合并写入，最多每 SAVE_INTERVAL 秒落盘一次"""
+        self._dirty = True
+        if time.time() - self._last_save >= SAVE_INTERVAL:
+            self.save()
+
+    def save(self):
+        self._prune()
+        self._dirty = False
+        self._last_save = time.time()
+        try:
+            tmp = self.path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self._buckets, ensure_ascii=False), encoding="utf-8")
+            tmp.replace(self.path)
+        except Exception as e:
+            logger.warning(f"[GiteeAIImage] 额度账本保存失败: {e}")
+
+    # ========== 成本模型 ==========
+
+    def cost(self, size: str, steps: int, endpoint: str = "generate") -> float:
+        """成本 = 像素 x 步数 x 接口系数"""
+        try:
+            w, h = (int(x) for x in size.lower().split("x"))
+        except ValueError:
+            w = h = 1024
+        cost = (w * h / BASE_PIXELS) * (steps / BASE_STEPS)
+        if endpoint == "edit":
+            cost *= self.config.get("quota_edit_multiplier", 3.0)
+        return round(cost, 3)
+
+    # ========== 令牌桶 ==========
+
+    def _limits(self, kind: str) -> tuple[float, float]:
+        capacity, refill = DEFAULT_LIMITS[kind]
+        return (
+            float(self.config.get(f"quota_{kind}_capacity", capacity)),
+            float(self.config.get(f"quota_{kind}_refill_per_hour", refill)),
+        )
+
+    def _bucket(self, kind: str, key: str) -> dict:
+        """取出桶并按时间恢复点数"""
+        capacity, refill = self._limits(kind)
+        now = time.time()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = {"tokens": capacity, "updated": now, "used": 0.0}
+        else:
+            elapsed = max(0.0, now - bucket["updated"])
+            bucket["tokens"] = min(capacity, bucket["tokens"] + elapsed * refill / 3600)
+            bucket["updated"] = now
+        return bucket
+
+    @staticmethod
+    def scopes(user_id: str, group_id: str = "") -> list[tuple[str, str]]:
+        scopes = [("user", f"user:{user_id}")]
+        if group_id:
+            scopes.append(("group", f"group:{group_id}"))
+        scopes.append(("global", "global"))
+        return scopes
+
+    def _affordable(self, scopes: list[tuple[str, str]], cost: float) -> bool:
+        for kind, key in scopes:
+            capacity, _ = self._limits(kind)
+            # 容量为 0 表示不限制
+            if capacity > 0 and self._bucket(kind, key)["tokens"] < cost:
+                return False
+        return True
+
+    def _charge(self, scopes: list[tuple[str, str]], cost: float):
+        for kind, key in scopes:
+            bucket = self._bucket(kind, key)
+            bucket["tokens"] -= cost
+            bucket["used"] += cost
+        self._mark_dirty()
+
+    def refund(self, scopes: list[tuple[str, str]], cost: float):
+        """生成失败时退还点数"""
+        if not cost:
+            return
+        for kind, key in scopes:
+            capacity, _ = self._limits(kind)
+            bucket = self._bucket(kind, key)
+            bucket["tokens"] = min(capacity, bucket["tokens"] + cost)
+            bucket["used"] = max(0.0, bucket["used"] - cost)
+        self._mark_dirty()
+
+    # ========== 准入控制 ==========
+
+    def try_charge(
+        self, scopes: list[tuple[str, str]], size: str, steps: int, endpoint: str = "generate"
+    ) -> float | None:
+        """额度足够时按原参数扣费并返回成本，否则返回 None (不降级)"""
+        if not self.enabled:
+            return 0.0
+        cost = self.cost(size, steps, endpoint)
+        if not self._affordable(scopes, cost):
+            return None
+        self._charge(scopes, cost)
+        return cost
+
+    def admit(
+        self,
+        scopes: list[tuple[str, str]],
+        size: str,
+        steps: int,
+        endpoint: str = "generate",
+        fallback_sizes: list[str] | None = None,
+    ) -> tuple[str, int, float] | None:
+        """检查额度并扣费，返回 (尺寸, 步数, 成本)；额度不足且无法降级时返回 None"""
+        if not self.enabled:
+            return size, steps, 0.0
+
+        candidates = [(size, steps)]
+        if endpoint == "generate" and self.config.get("quota_over_policy", "degrade") == "degrade":
+            # 先降分辨率，再在最小分辨率上降步数
+            sizes = [size] + list(fallback_sizes or [])
+            candidates += [(s, steps) for s in sizes[1:]]
+            min_steps = max(1, int(self.config.get("quota_min_steps", 4)))
+            s = steps
+            while True:
+                # 每次减半，不低于 min_steps；不再下降时停止
+                next_s = max(min_steps, s // 2)
+                if next_s >= s:
+                    break
+                candidates.append((sizes[-1], next_s))
+                s = next_s
+
+        for c_size, c_steps in candidates:
+            cost = self.cost(c_size, c_steps, endpoint)
+            if self._affordable(scopes, cost):
+                self._charge(scopes, cost)
+                if (c_size, c_steps) != (size, steps):
+                    logger.info(f"[Quota] 额度不足，降级: {size}/{steps}步 -> {c_size}/{c_steps}步")
+                return c_size, c_steps, cost
+        return None
+
+    def close(self):
+        if self._dirty:
+            self.save()
+
+    def get_usage(self, kind: str, key: str) -> dict:
+        capacity, refill = self._limits(kind)
+        bucket = self._bucket(kind, key)
+        return {
+            "tokens": bucket["tokens"],
+            "capacity": capacity,
+            "refill": refill,
+            "used": bucket["used"],
+        }
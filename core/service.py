@@ -6,6 +6,7 @@ from astrbot.api import logger
 from .image import ImageManager
 
 EDIT_TASK_TYPES = ["id", "style", "subject", "background", "element"]
+EDIT_INFERENCE_STEPS = 4
 
 class ImageService:
     def __init__(self, config: dict, imgr: ImageManager):
@@ -21,6 +22,13 @@ class ImageService:
         self.edit_keys = self._parse_keys(config.get("edit_api_key")) or self.api_keys
         self._edit_key_idx = 0
 
+        # 进行中的请求数，用于判断 Key 池是否空闲
+        self._inflight = 0
+
+    @property
+    def is_idle(self) -> bool:
+        return self._inflight == 0
+
     async def close(self):
         for c in self._clients.values():
             await c.close()
@@ -62,6 +70,7 @@ class ImageService:
 
     async def smart_filter_outfit(self, outfit: str, user_prompt: str) -> str:
         """调用文本模型清洗穿搭"""
+        self._inflight += 1
         try:
             client, _ = self._get_client()
             model = self.config.get("text_model", "deepseek-ai/DeepSeek-V3")
@@ -87,20 +96,23 @@ class ImageService:
         except Exception as e:
             logger.warning(f"智能穿搭判断失败: {e}")
             return outfit
+        finally:
+            self._inflight -= 1
 
     # ========== 文生图 ==========
 
-    async def generate(self, prompt: str, size: str) -> Path:
+    async def generate(self, prompt: str, size: str, steps: int | None = None) -> Path:
         client, _ = self._get_client()
         kwargs = {
             "prompt": prompt,
             "model": self.config.get("model", "z-image-turbo"),
             "size": size,
-            "extra_body": {"num_inference_steps": self.config.get("num_inference_steps", 9)}
+            "extra_body": {"num_inference_steps": steps or self.config.get("num_inference_steps", 9)}
         }
         if self.config.get("negative_prompt"):
             kwargs["extra_body"]["negative_prompt"] = self.config.get("negative_prompt")
         
+        self._inflight += 1
         try:
             resp = await client.images.generate(**kwargs)
             img = resp.data[0]
@@ -111,10 +123,19 @@ class ImageService:
             if "401" in str(e): raise RuntimeError("API Key 无效") from e
             if "429" in str(e): raise RuntimeError("请求过快") from e
             raise
+        finally:
+            self._inflight -= 1
 
     # ========== 图生图 ==========
 
     async def edit_image(self, prompt: str, images: list[bytes], types: list[str]) -> Path:
+        self._inflight += 1
+        try:
+            return await self._edit_image(prompt, images, types)
+        finally:
+            self._inflight -= 1
+
+    async def _edit_image(self, prompt: str, images: list[bytes], types: list[str]) -> Path:
         # 1. 创建任务
         _, api_key = self._get_client(for_edit=True) # 仅为了轮询 Key
         base_url = self.config.get("edit_base_url") or self.config.get("base_url")
@@ -122,7 +143,7 @@ class ImageService:
         data = aiohttp.FormData()
         data.add_field("prompt", prompt)
         data.add_field("model", "Qwen-Image-Edit-2511") # 固定模型
-        data.add_field("num_inference_steps", "4")
+        data.add_field("num_inference_steps", str(EDIT_INFERENCE_STEPS))
         data.add_field("guidance_scale", "1.0")
         for t in types: data.add_field("task_types", t)
         
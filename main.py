@@ -7,7 +7,10 @@ import datetime
 
 from .core.debouncer import Debouncer
 from .core.image import ImageManager
-from .core.service import ImageService, EDIT_TASK_TYPES
+from .core.prefetch import SelfiePrefetcher
+from .core.prompt_cache import PromptCache
+from .core.quota import QuotaLedger
+from .core.service import ImageService, EDIT_TASK_TYPES, EDIT_INFERENCE_STEPS
 
 
 @register(
@@ -42,9 +45,20 @@ class GiteeAIImage(Star):
         self.debouncer = Debouncer(self.config)
         self.imgr = ImageManager(self.config, self.data_dir)
         self.service = ImageService(self.config, self.imgr)
+        self.prompt_cache = PromptCache(self.config)
+        self.quota = QuotaLedger(self.config, self.data_dir)
+        self.prefetcher = SelfiePrefetcher(
+            self.config,
+            self.service,
+            self.quota,
+            get_outfit=self._get_scheduler_outfit,
+            build_prompt=self._build_self_prompt,
+            is_idle=lambda: not self.processing_users and self.service.is_idle,
+        )
         
         # 启动缓存清理任务
         await self.imgr.start_cleanup_task()
+        await self.prefetcher.start()
 
     async def terminate(self):
         # 取消后台任务
@@ -54,6 +68,9 @@ class GiteeAIImage(Star):
 
         # 清理资源
         self.debouncer.clear_all()
+        self.prompt_cache.clear_all()
+        await self.prefetcher.close()
+        self.quota.close()
         await self.imgr.close()
         await self.service.close()
 
@@ -83,6 +100,45 @@ class GiteeAIImage(Star):
             logger.warning(f"[GiteeAIImage] 获取穿搭异常: {e}")
             return ""
 
+    async def _build_self_prompt(self, prompt: str, outfit: str) -> str:
+        """拼接穿搭与人设前缀"""
+        final_prompt = prompt
+        # 1. 穿搭注入
+        if outfit:
+            # 智能清洗穿搭
+            refined_outfit = await self.service.smart_filter_outfit(outfit, prompt)
+            final_prompt = f"({refined_outfit}), {prompt}"
+
+        # 2. 人设前缀注入
+        if self.config.get("auto_inject_persona") and self.config.get("persona_prefix"):
+            final_prompt = f"{self.config['persona_prefix']} {final_prompt}"
+        return final_prompt
+
+    def _cache_scope(self, size: str, tag: str) -> str:
+        return PromptCache.make_scope(self.config.get("model", "z-image-turbo"), size, tag)
+
+    def _quota_scopes(self, event: AstrMessageEvent) -> list[tuple[str, str]]:
+        return QuotaLedger.scopes(event.get_sender_id(), event.get_group_id())
+
+    def _fallback_sizes(self, size: str) -> list[str]:
+        """同比例下更小的分辨率，按面积从大到小"""
+        def area(s: str) -> int:
+            w, h = s.split("x")
+            return int(w) * int(h)
+
+        for sizes in self.SUPPORTED_RATIOS.values():
+            if size in sizes:
+                return sorted((s for s in sizes if area(s) < area(size)), key=area, reverse=True)
+        return []
+
+    def _admit_generate(self, event: AstrMessageEvent, size: str) -> tuple[str, int, float] | None:
+        return self.quota.admit(
+            self._quota_scopes(event),
+            size,
+            self.config.get("num_inference_steps", 9),
+            fallback_sizes=self._fallback_sizes(size),
+        )
+
     # ========== 文生图功能 ==========
 
     @filter.llm_tool(name="draw_image")
@@ -105,33 +161,44 @@ class GiteeAIImage(Star):
             return "您有正在进行的生图任务，请稍候..."
 
         self.processing_users.add(request_id)
+        charged = 0.0
         
         try:
-            final_prompt = prompt
-            # 人设与穿搭注入逻辑 
-            if is_self:
-                # 1. 穿搭注入
-                outfit = await self._get_scheduler_outfit()
-                if outfit:
-                    # 智能清洗穿搭
-                    refined_outfit = await self.service.smart_filter_outfit(outfit, prompt)
-                    final_prompt = f"({refined_outfit}), {prompt}"
-                
-                # 2. 人设前缀注入 (通过 Service 层处理或在此处理，这里选择在此拼接)
-                if self.config.get("auto_inject_persona") and self.config.get("persona_prefix"):
-                    final_prompt = f"{self.config['persona_prefix']} {final_prompt}"
-
-            logger.info(f"[draw_image] Prompts: {final_prompt[:50]}... (is_self={is_self})")
-            
             # 使用配置的默认尺寸
             target_size = self.config.get("size", "1024x1024")
-            image_path = await self.service.generate(final_prompt, size=target_size)
+            outfit = await self._get_scheduler_outfit() if is_self else ""
+
+            # 近似提示词缓存 (按用户原始描述匹配，人设/穿搭前缀计入分桶)
+            cache_tag = f"self:{outfit}" if is_self else "plain"
+            image_path = self.prompt_cache.lookup(prompt, self._cache_scope(target_size, cache_tag))
+            if image_path:
+                logger.info(f"[draw_image] 命中近似缓存: {prompt[:30]}...")
+                await event.send(event.chain_result([Image.fromFileSystem(str(image_path))]))
+                return "图片已成功生成并发送。请用文字自然地回复用户，不要再调用工具。"
+
+            # 预生成的自拍 (与今日穿搭、默认尺寸绑定)
+            image_path = await self.prefetcher.take(prompt, outfit) if is_self else None
+            if image_path:
+                self.prompt_cache.store(prompt, self._cache_scope(target_size, cache_tag), image_path)
+            else:
+                # 额度检查 (不足时可能降级尺寸/步数)
+                admission = self._admit_generate(event, target_size)
+                if not admission:
+                    return "生图额度不足，请稍后再试。可使用 /aiimg_quota 查看额度。"
+                size, steps, charged = admission
+
+                # 人设与穿搭注入逻辑 
+                final_prompt = await self._build_self_prompt(prompt, outfit) if is_self else prompt
+                logger.info(f"[draw_image] Prompts: {final_prompt[:50]}... (is_self={is_self})")
+                image_path = await self.service.generate(final_prompt, size=size, steps=steps)
+                self.prompt_cache.store(prompt, self._cache_scope(size, cache_tag), image_path)
             
             await event.send(event.chain_result([Image.fromFileSystem(str(image_path))]))
             return "图片已成功生成并发送。请用文字自然地回复用户，不要再调用工具。"
 
         except Exception as e:
             logger.error(f"生图失败: {e}")
+            self.quota.refund(self._quota_scopes(event), charged)
             return f"生成图片时遇到问题: {str(e)}"
         finally:
             self.processing_users.discard(request_id)
@@ -168,12 +235,24 @@ class GiteeAIImage(Star):
         else:
             target_size = default_size
 
+        charged = 0.0
         try:
             # 指令模式不注入人设，保持纯净
-            image_path = await self.service.generate(prompt, size=target_size)
+            image_path = self.prompt_cache.lookup(prompt, self._cache_scope(target_size, "plain"))
+            if not image_path:
+                admission = self._admit_generate(event, target_size)
+                if not admission:
+                    yield event.plain_result("生图额度不足，请稍后再试。使用 /aiimg_quota 查看额度。")
+                    return
+                size, steps, charged = admission
+                if size != target_size:
+                    yield event.plain_result(f"额度紧张，已降级为 {size} 生成。")
+                image_path = await self.service.generate(prompt, size=size, steps=steps)
+                self.prompt_cache.store(prompt, self._cache_scope(size, "plain"), image_path)
             yield event.chain_result([Image.fromFileSystem(str(image_path))])
         except Exception as e:
             logger.error(f"命令生图失败: {e}")
+            self.quota.refund(self._quota_scopes(event), charged)
             yield event.plain_result(f"生成失败: {str(e)}")
         finally:
             self.processing_users.discard(request_id)
@@ -212,6 +291,13 @@ class GiteeAIImage(Star):
         if not image_data_list:
             return "请在消息中附带需要编辑的图片。提示：发送图片或引用图片后再发送修改指令。"
 
+        # 图生图无法降级，额度不足直接拒绝
+        quota_scopes = self._quota_scopes(event)
+        admission = self.quota.admit(quota_scopes, self.config.get("size", "1024x1024"), EDIT_INFERENCE_STEPS, "edit")
+        if not admission:
+            return "图生图额度不足，请稍后再试。可使用 /aiimg_quota 查看额度。"
+        charged = admission[2]
+
         self.processing_users.add(request_id)
         types = [t.strip() for t in task_types.split(",") if t.strip()]
 
@@ -223,6 +309,7 @@ class GiteeAIImage(Star):
                 logger.info(f"[edit_image] 完成: {prompt[:30]}")
             except Exception as e:
                 logger.error(f"[edit_image] 失败: {e}")
+                self.quota.refund(quota_scopes, charged)
                 await event.send(event.plain_result(f"编辑图片失败: {str(e)}"))
             finally:
                 self.processing_users.discard(request_id)
@@ -257,6 +344,13 @@ class GiteeAIImage(Star):
             yield event.plain_result("请在消息中附带需要编辑的图片！(发送或引用)")
             return
 
+        quota_scopes = self._quota_scopes(event)
+        admission = self.quota.admit(quota_scopes, self.config.get("size", "1024x1024"), EDIT_INFERENCE_STEPS, "edit")
+        if not admission:
+            yield event.plain_result("图生图额度不足，请稍后再试。使用 /aiimg_quota 查看额度。")
+            return
+        charged = admission[2]
+
         self.processing_users.add(request_id)
         
         # 解析任务类型
@@ -273,6 +367,7 @@ class GiteeAIImage(Star):
             image_path = await self.service.edit_image(prompt, image_data_list, task_types)
             yield event.chain_result([Image.fromFileSystem(str(image_path))])
         except Exception as e:
+            self.quota.refund(quota_scopes, charged)
             yield event.plain_result(f"编辑失败: {str(e)}")
         finally:
             self.processing_users.discard(request_id)
@@ -291,6 +386,7 @@ class GiteeAIImage(Star):
         yield event.plain_result(msg)
 
         deleted_count, freed_bytes = await self.imgr.clean_all_cache()
+        self.prompt_cache.clear_all()
         freed_mb = freed_bytes / (1024 * 1024)
         
         yield event.plain_result(f"✅ 清理完成\n删除: {deleted_count} 张\n释放: {freed_mb:.2f} MB")
@@ -312,4 +408,48 @@ class GiteeAIImage(Star):
             f"保留时间: {self.config.get('cache_max_age_hours')} 小时",
             f"数量上限: {self.config.get('cache_max_count')} 张",
         ]
+        if self.prompt_cache.enabled:
+            pc = self.prompt_cache.get_stats()
+            lines += [
+                "━━━━━━━━━━━━━━━",
+                f"近似缓存: {pc['entries']} 条",
+                f"命中/未命中: {pc['hits']}/{pc['misses']}",
+                f"命中率: {pc['hit_rate']:.1%}",
+            ]
+        if self.prefetcher.enabled:
+            pf = self.prefetcher.get_stats()
+            lines += [
+                "━━━━━━━━━━━━━━━",
+                f"预生成自拍: {pf['ready']}/{pf['total']} 张就绪",
+                f"已直接发送: {pf['served']} 次",
+            ]
+        yield event.plain_result("\n".join(lines))
+
+    # ========== 额度管理 ==========
+
+    @filter.command("aiimg_quota")
+    async def quota_command(self, event: AstrMessageEvent):
+        """查看生图额度"""
+        if not self.quota.enabled:
+            yield event.plain_result("额度控制未启用")
+            return
+
+        labels = {"user": "个人", "group": "本群", "global": "全局"}
+        lines = ["📊 生图额度", "━━━━━━━━━━━━━━━"]
+        for kind, key in self._quota_scopes(event):
+            usage = self.quota.get_usage(kind, key)
+            if usage["capacity"] <= 0:
+                lines.append(f"{labels[kind]}: 不限")
+                continue
+            lines.append(
+                f"{labels[kind]}: {usage['tokens']:.1f}/{usage['capacity']:.0f} 点 "
+                f"(每小时恢复 {usage['refill']:.0f}, 近期已用 {usage['used']:.1f})"
+            )
+        size = self.config.get("size", "1024x1024")
+        steps = self.config.get("num_inference_steps", 9)
+        lines += [
+            "━━━━━━━━━━━━━━━",
+            f"文生图 {size}/{steps}步: {self.quota.cost(size, steps):.2f} 点/张",
+            f"图生图: {self.quota.cost(size, EDIT_INFERENCE_STEPS, 'edit'):.2f} 点/张",
+        ]
         yield event.plain_result("\n".join(lines))